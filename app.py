@@ -1,18 +1,27 @@
-import json
 import os
+import heapq
+import hashlib
 import re
 import sys
+import selectors
 import time
-import glob
+import shutil
 import secrets
+import tempfile
 import logging
+import threading
 import urllib.parse
 import subprocess
+import orjson
 import requests
+import yt_dlp
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from dataclasses import dataclass, field
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, Future
-from typing import Optional, Dict, Any, List
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FutureTimeoutError
+from operator import itemgetter
+from typing import Optional, Dict, Any, List, Tuple, Deque, Iterator, Callable
 
 from flask import (
     Flask,
@@ -20,13 +29,21 @@ from flask import (
     jsonify,
     request,
     render_template,
-    send_file,
+    send_from_directory,
     stream_with_context,
     abort,
 )
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.wsgi import FileWrapper
 
 from cobalt_fallback import CobaltDownloader
 
+try:
+    from gevent import Timeout as GeventTimeout, get_hub as gevent_hub
+    from gevent.monkey import is_module_patched
+except ImportError:  # plain `python app.py` without gevent installed
+    gevent_hub = None
+
 
 # ----------------------------
 # Configuration & Constants
@@ -37,18 +54,51 @@ MAX_CONCURRENT = int(os.getenv("MAX_CONCURRENT", "3"))
 FILE_RETENTION_HOURS = int(os.getenv("FILE_RETENTION_HOURS", "24"))
 YTDLP_TIMEOUT = int(os.getenv("YTDLP_TIMEOUT", "300"))
 PORT = int(os.getenv("PORT", "5000"))
+ANALYZE_CACHE_TTL = int(os.getenv("ANALYZE_CACHE_TTL", "86400"))  # seconds
+# e.g. "/internal-downloads/": hand file bodies to nginx via X-Accel-Redirect
+XACCEL_REDIRECT_PREFIX = os.getenv("XACCEL_REDIRECT_PREFIX", "")
+# Apache/lighttpd: let the server send files named by an X-Sendfile header
+USE_X_SENDFILE = os.getenv("USE_X_SENDFILE", "").lower() in ("1", "true", "yes")
 
-SUPPORTED_SITES = ["youtube.com", "youtu.be", "m.youtube.com", "www.youtube.com"]
+SUPPORTED_SITES = frozenset({"youtube.com", "youtu.be", "m.youtube.com", "www.youtube.com"})
 MAX_FILE_SIZE = 5 * 1024**3  # 5GB
 PROGRESS_UPDATE_INTERVAL = 0.5  # seconds
+CANCEL_POLL_INTERVAL = 0.2  # seconds
+STDERR_TAIL_BYTES = 64 * 1024  # stderr kept for error reporting
+HEALTH_CACHE_TTL = 30  # seconds
+YTDLP_VERSION_TTL = 300  # seconds
+CLEANUP_INTERVAL = 60  # seconds between expiry/prune passes
+ANALYZE_CACHE_SIZE = 256  # entries
+RAW_INFO_CACHE_SIZE = 32  # full yt-dlp info dicts are large (100KB+)
+COBALT_CACHE_SIZE = 512  # entries
+RAW_INFO_TTL = 1800  # seconds; stream URLs inside expire after a few hours
+COBALT_CACHE_TTL = 300  # seconds; Cobalt's signed download URLs are short-lived
+FILE_CHUNK_SIZE = 1 << 20  # 1MB reads when streaming files through Python
+MAX_TRACKED_DOWNLOADS = 10_000  # finished entries are evicted oldest-first beyond this
 
 
 # ----------------------------
 # Flask App & Logger
 # ----------------------------
 
+def json_dumpb(obj: Any) -> bytes:
+    return orjson.dumps(obj, default=DefaultJSONProvider.default, option=orjson.OPT_NON_STR_KEYS)
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson (jsonify, request.get_json)."""
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return json_dumpb(obj).decode()
+
+    def loads(self, s: Any, **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
 app.config["JSON_SORT_KEYS"] = False
+app.config["USE_X_SENDFILE"] = USE_X_SENDFILE
+app.json = OrjsonProvider(app)
 
 logging.basicConfig(
     level=logging.INFO,
@@ -63,22 +113,134 @@ log = logging.getLogger("fetch")
 # ----------------------------
 
 
+# Every accepted "scheme://host/" spelling; str.startswith(tuple) checks them in C
+_URL_PREFIXES = tuple(f"{scheme}://{host}/" for scheme in ("https", "http") for host in sorted(SUPPORTED_SITES))
+# \Z rather than $ so a trailing newline can't slip through
+_FORMAT_ID_RE = re.compile(r"[a-zA-Z0-9+\-]+\Z")
+_DOWNLOAD_ID_RE = re.compile(r"[a-zA-Z0-9_\-]{16,32}\Z")
+
+
 def is_valid_youtube_url(url: str) -> bool:
     if not url or len(url) > 500:
         return False
-    try:
-        parsed = urllib.parse.urlparse(url)
-    except Exception:
-        return False
-    if parsed.netloc not in SUPPORTED_SITES:
-        return False
-    if parsed.scheme not in ["http", "https"]:
-        return False
-    return True
+    return url.startswith(_URL_PREFIXES)
+
+
+def normalize_youtube_url(url: str) -> str:
+    """Canonicalize a YouTube URL to https://www.youtube.com/watch?v=<id>.
+
+    Tracking params (si, t, feature, list, ...) are dropped so that every
+    spelling of the same video maps to one cache key. URLs we cannot map to a
+    video ID are returned unchanged.
+    """
+    parsed = urllib.parse.urlparse(url)
+    host = parsed.netloc.lower()
+    path = parsed.path
+    video_id = ""
+    if host == "youtu.be":
+        video_id = path.lstrip("/").split("/", 1)[0]
+    elif path == "/watch":
+        video_id = urllib.parse.parse_qs(parsed.query).get("v", [""])[0]
+    elif path.startswith(("/shorts/", "/embed/", "/live/")):
+        video_id = path.split("/", 3)[2]
+    if not video_id:
+        return url
+    return f"https://www.youtube.com/watch?v={video_id}"
+
+
+class TTLCache:
+    """Small thread-safe LRU cache whose entries expire after `ttl` seconds."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Any, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Any) -> Optional[Any]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Any, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Any) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+
+class ShardedDict:
+    """Dict split across lock-guarded shards so unrelated keys don't contend.
+
+    Every access takes the owning shard's lock, which keeps the map correct
+    without relying on the GIL (free-threaded builds, concurrent iteration).
+    """
+
+    def __init__(self, shards: int = 16):
+        self._mask = shards - 1  # shards must be a power of two
+        self._shards: List[Dict[Any, Any]] = [{} for _ in range(shards)]
+        self._locks = [threading.Lock() for _ in range(shards)]
+
+    def _index(self, key: Any) -> int:
+        return hash(key) & self._mask
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        i = self._index(key)
+        with self._locks[i]:
+            return self._shards[i].get(key, default)
+
+    def set(self, key: Any, value: Any) -> None:
+        i = self._index(key)
+        with self._locks[i]:
+            self._shards[i][key] = value
+
+    def pop(self, key: Any, default: Any = None) -> Any:
+        i = self._index(key)
+        with self._locks[i]:
+            return self._shards[i].pop(key, default)
+
+    def snapshot(self) -> List[Tuple[Any, Any]]:
+        items: List[Tuple[Any, Any]] = []
+        for lock, shard in zip(self._locks, self._shards):
+            with lock:
+                items.extend(shard.items())
+        return items
+
+    def discard_if(self, predicate: Callable[[Any, Any], bool]) -> int:
+        """Remove entries for which predicate(key, value) is true; returns the count."""
+        removed = 0
+        for lock, shard in zip(self._locks, self._shards):
+            with lock:
+                for key in [k for k, v in shard.items() if predicate(k, v)]:
+                    del shard[key]
+                    removed += 1
+        return removed
+
+    @contextmanager
+    def locked_shard(self, key: Any) -> Iterator[Dict[Any, Any]]:
+        """Hold the lock for `key`'s shard and yield the raw shard dict."""
+        i = self._index(key)
+        with self._locks[i]:
+            yield self._shards[i]
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self._shards)
 
 
 def sanitize_format_id(format_id: str) -> str:
-    if not re.match(r"^[a-zA-Z0-9+\-]+$", format_id or ""):
+    if not _FORMAT_ID_RE.match(format_id or ""):
         raise ValueError("Invalid format ID")
     return format_id
 
@@ -89,16 +251,62 @@ def ensure_download_dir(path: str) -> Path:
     return p
 
 
+PARTIAL_SUFFIXES = (".part", ".ytdl")
+
+
+def scan_download_files(directory: Path, download_id: str, include_partial: bool = True) -> List[str]:
+    """List files named `<download_id>.*` with one scandir pass (no fnmatch/stat)."""
+    prefix = f"{download_id}."
+    with os.scandir(directory) as entries:
+        return [
+            e.path
+            for e in entries
+            if e.name.startswith(prefix) and (include_partial or not e.name.endswith(PARTIAL_SUFFIXES))
+        ]
+
+
+# Native threads for run_native without gevent; headroom for calls abandoned at their deadline
+_native_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT * 2, thread_name_prefix="native")
+
+
+def run_native(fn: Callable[..., Any], *args: Any, timeout: float) -> Any:
+    """Run CPU-bound `fn` on a real OS thread so it can't stall the gevent hub."""
+    # Threads can't be killed: past the deadline the caller gets TimeoutError and moves
+    # on, while the abandoned call ends at its next socket timeout
+    if gevent_hub is not None and is_module_patched("threading"):
+        try:
+            return gevent_hub().threadpool.spawn(fn, *args).get(timeout=timeout)
+        except GeventTimeout:
+            raise TimeoutError(f"{fn.__name__} exceeded {timeout}s")
+    try:
+        return _native_executor.submit(fn, *args).result(timeout=timeout)
+    except FutureTimeoutError:
+        raise TimeoutError(f"{fn.__name__} exceeded {timeout}s")
+
+
+# Environment for yt-dlp subprocesses (HOME=/tmp isolates user config), built once
+YTDLP_ENV = {**os.environ, "HOME": "/tmp"}
+
+
 def get_ytdlp_binary() -> str:
     return "yt-dlp"
 
 
+_ytdlp_version_cache = TTLCache(maxsize=1, ttl=YTDLP_VERSION_TTL)
+
+
 def get_ytdlp_version() -> Optional[str]:
+    # Cached so health probes don't fork yt-dlp; failures are not cached
+    version = _ytdlp_version_cache.get("version")
+    if version is not None:
+        return version
     try:
-        result = subprocess.run([get_ytdlp_binary(), "--version"], capture_output=True, text=True, timeout=5, check=True)
-        return result.stdout.strip()
+        result = subprocess.run([get_ytdlp_binary(), "--version"], capture_output=True, text=True, timeout=5, check=True, env=YTDLP_ENV)
     except Exception:
         return None
+    version = result.stdout.strip()
+    _ytdlp_version_cache.set("version", version)
+    return version
 
 
 # ----------------------------
@@ -106,26 +314,76 @@ def get_ytdlp_version() -> Optional[str]:
 # ----------------------------
 
 
+# Request settings shared by analysis and downloads (403 workarounds). Downloads load
+# the analyzer's info, whose stored headers and formats win over command-line flags,
+# so both must extract the same way.
+YTDLP_HTTP_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+    "Referer": "https://www.youtube.com/",
+    "Accept-Language": "en-US,en;q=0.9",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    "Sec-Fetch-Mode": "navigate",
+}
+# Multiple player clients for better compatibility
+YTDLP_PLAYER_CLIENTS = ("ios", "android", "web")
+
+YTDLP_INFO_OPTS = {
+    "quiet": True,
+    "no_warnings": True,
+    "skip_download": True,
+    "noplaylist": True,
+    # Don't probe every format URL; the UI only needs the advertised list
+    "check_formats": False,
+    "extractor_args": {"youtube": {"player_client": list(YTDLP_PLAYER_CLIENTS)}},
+    "http_headers": dict(YTDLP_HTTP_HEADERS),
+    "nocheckcertificate": True,
+    "source_address": "0.0.0.0",  # Force IPv4, as -4 does for downloads
+    "format_sort": ["res", "ext:mp4:m4a"],
+}
+
+# Sort key for _parse_formats' (quality, format) pairs
+_QUALITY_KEY = itemgetter(0)
+
+
 class YtDlpError(Exception):
     pass
 
 
 class FormatAnalyzer:
-    def __init__(self, timeout: int = 30):
+    def __init__(self, executor: ThreadPoolExecutor, timeout: int = 30, cache_ttl: int = ANALYZE_CACHE_TTL):
+        self.executor = executor
         self.timeout = timeout
+        # Parsed results only (no signed stream URLs), so a long TTL is safe
+        self.cache = TTLCache(maxsize=ANALYZE_CACHE_SIZE, ttl=cache_ttl)
+        # Unparsed info handed to downloads so yt-dlp does not extract the video again
+        self.raw_info = TTLCache(maxsize=RAW_INFO_CACHE_SIZE, ttl=RAW_INFO_TTL)
+        self._local = threading.local()
+
+    def get_formats_async(self, url: str, timeout: Optional[int] = None) -> Future:
+        cached = self.cache.get(normalize_youtube_url(url))
+        if cached is not None:
+            future: Future = Future()
+            future.set_result(cached)
+            return future
+        return self.executor.submit(self._get_formats_blocking, url, timeout)
+
+    def _get_formats_blocking(self, url: str, timeout: Optional[int] = None) -> Dict[str, Any]:
+        key = normalize_youtube_url(url)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
 
-    def get_formats(self, url: str, timeout: Optional[int] = None) -> Dict[str, Any]:
         effective_timeout = timeout or self.timeout
         try:
             info = self._run_yt_dlp_info(url, effective_timeout)
+            self.raw_info.set(key, yt_dlp.YoutubeDL.sanitize_info(info, remove_private_keys=True))
             parsed = self._parse_formats(info)
-            parsed["formats"] = self._add_quality_labels(parsed["formats"])
-            parsed["categorized"] = self.categorize_formats(parsed["formats"])  # convenience for UI
+            self.cache.set(key, parsed)
             return parsed
-        except subprocess.TimeoutExpired:
-            raise TimeoutError("yt-dlp took too long to respond")
-        except subprocess.CalledProcessError as e:
-            error_msg = e.stderr if isinstance(e.stderr, str) else (e.stderr.decode() if e.stderr else str(e))
+        except yt_dlp.utils.DownloadError as e:
+            error_msg = str(e)
+            if "timed out" in error_msg:
+                raise TimeoutError("yt-dlp took too long to respond")
             if "Sign in to confirm your age" in error_msg:
                 raise YtDlpError("Age-restricted video (not supported)")
             if "Video unavailable" in error_msg:
@@ -133,172 +391,146 @@ class FormatAnalyzer:
             if "Unsupported URL" in error_msg:
                 raise YtDlpError("URL not recognized as valid YouTube link")
             raise YtDlpError(f"yt-dlp error: {error_msg}")
-        except json.JSONDecodeError:
-            raise YtDlpError("yt-dlp output format unreadable (try updating)")
+
+    def invalidate(self, url: str) -> None:
+        key = normalize_youtube_url(url)
+        self.cache.pop(key)
+        self.raw_info.pop(key)
+
+    def get_raw_info(self, url: str) -> Optional[Dict[str, Any]]:
+        return self.raw_info.get(normalize_youtube_url(url))
 
     def _run_yt_dlp_info(self, url: str, timeout: int) -> Dict[str, Any]:
-        result = subprocess.run(
-            [
-                get_ytdlp_binary(),
-                "--dump-json",
-                "--no-playlist",
-                "--no-warnings",
-                "--skip-download",
-                url,
-            ],
-            capture_output=True,
-            timeout=timeout,
-            check=True,
-            text=True,
-            shell=False,
-            env={**os.environ, "HOME": "/tmp"},
-        )
-        return json.loads(result.stdout)
+        # In-process extraction: no interpreter startup, extractor import or
+        # JSON round-trip per call. Downloads still run as isolated subprocesses.
+        # Hard deadline: frees the analyze slot even if extraction stalls
+        return run_native(self._extract_info, url, timeout, timeout=timeout)
+
+    def _extract_info(self, url: str, timeout: int) -> Dict[str, Any]:
+        return self._get_ydl(timeout).extract_info(url, download=False)
+
+    def _get_ydl(self, timeout: int) -> yt_dlp.YoutubeDL:
+        # One YoutubeDL per extraction thread (and timeout) so extractor instances
+        # are reused. socket_timeout must be set at construction: yt-dlp reads it
+        # once when it builds its request handlers.
+        ydls = getattr(self._local, "ydls", None)
+        if ydls is None:
+            ydls = self._local.ydls = {}
+        ydl = ydls.get(timeout)
+        if ydl is None:
+            ydl = ydls[timeout] = yt_dlp.YoutubeDL({**YTDLP_INFO_OPTS, "socket_timeout": timeout})
+        return ydl
 
     def _parse_formats(self, info: Dict[str, Any]) -> Dict[str, Any]:
-        formats: List[Dict[str, Any]] = []
-        seen_formats = {}  # Map dedup key to best format
-        
+        # Single pass over yt-dlp's formats: filter, build, label and dedup
+        # Map dedup key to (quality sort key, best format)
+        seen_formats: Dict[tuple, Tuple[Tuple[float, ...], Dict[str, Any]]] = {}
+
         for f in info.get("formats", []):
+            _g = f.get
             # Skip storyboards and other non-downloadable formats
-            if f.get("format_note") == "storyboard":
+            if _g("format_note") == "storyboard":
                 continue
-            
-            # Extract key properties
-            format_id = f.get("format_id", "")
-            vcodec = f.get("vcodec", "none")
-            acodec = f.get("acodec", "none")
-            
+
+            vcodec = _g("vcodec", "none")
+            acodec = _g("acodec", "none")
+
             # Skip if both codecs are none
             if vcodec == "none" and acodec == "none":
                 continue
-            
+
             # Skip formats with protocol issues
-            protocol = f.get("protocol", "")
-            if protocol and protocol in ["mhtml", "niconico_dmc"]:
+            if _g("protocol") in ("mhtml", "niconico_dmc"):
                 continue
-            
-            # Build format data
-            fmt = {
-                "format_id": format_id,
-                "ext": f.get("ext", "unknown"),
-                "filesize": f.get("filesize") or f.get("filesize_approx"),
-                "vcodec": vcodec,
-                "acodec": acodec,
-                "fps": f.get("fps"),
-                "vbr": f.get("vbr"),
-                "abr": f.get("abr"),
-                "width": f.get("width"),
-                "height": f.get("height"),
-                "tbr": f.get("tbr"),  # Total bitrate
-            }
-            
-            # Set resolution
+
+            ext = _g("ext", "unknown")
+            fps = _g("fps")
+            abr = _g("abr")
+            width = _g("width")
+            height = _g("height")
+            filesize = _g("filesize") or _g("filesize_approx")
+            tbr = _g("tbr")  # Total bitrate
+
             if vcodec != "none":
-                width = f.get("width")
-                height = f.get("height")
-                if width and height:
-                    fmt["resolution"] = f"{width}x{height}"
-                else:
-                    fmt["resolution"] = f.get("resolution", "unknown")
+                resolution = f"{width}x{height}" if width and height else _g("resolution", "unknown")
             else:
-                fmt["resolution"] = "audio only"
-            
+                resolution = "audio only"
+
             # Create deduplication key
             dedup_key = (
-                fmt["resolution"],
-                fmt["ext"],
-                fmt["vcodec"][:20] if fmt["vcodec"] != "none" else "none",  # Truncate codec details
-                fmt["acodec"][:20] if fmt["acodec"] != "none" else "none",
-                int(fmt["fps"] or 0),
-                int(fmt["abr"] or 0),
+                resolution,
+                ext,
+                vcodec[:20] if vcodec != "none" else "none",  # Truncate codec details
+                acodec[:20] if acodec != "none" else "none",
+                int(fps or 0),
+                int(abr or 0),
             )
-            
-            # Keep best format for each dedup key
-            if dedup_key in seen_formats:
-                existing = seen_formats[dedup_key]
+            # Quality (height for video, abr for audio), normalized once here for the sort
+            quality = (height or 0, fps or 0, abr or 0, tbr or 0)
+
+            # Keep best format for each dedup key; a loser is skipped before its dict is built
+            existing = seen_formats.get(dedup_key)
+            if existing is not None and not (
                 # Prefer format with filesize info
-                if fmt["filesize"] and not existing["filesize"]:
-                    seen_formats[dedup_key] = fmt
+                (filesize and not existing[1]["filesize"])
                 # If both have filesize or both don't, prefer higher bitrate
-                elif fmt.get("tbr", 0) > existing.get("tbr", 0):
-                    seen_formats[dedup_key] = fmt
+                or quality[3] > existing[0][3]
+            ):
+                continue
+
+            if vcodec != "none":
+                fps_str = f" {int(fps)}fps" if fps else ""
+                quality_str = f"{height}p" if height else resolution
+                suffix = "" if acodec != "none" else " (video only)"
+                quality_label = f"{quality_str}{fps_str} • {ext.upper()}{suffix}"
             else:
-                seen_formats[dedup_key] = fmt
-        
-        # Don't filter out formats without filesize - keep all valid formats
-        formats = list(seen_formats.values())
-        
-        # Sort by quality (height for video, abr for audio)
-        formats.sort(key=lambda f: (
-            -(f.get("height") or 0),
-            -(f.get("fps") or 0),
-            -(f.get("abr") or 0),
-            -(f.get("tbr") or 0)
-        ))
-        
+                bitrate = f"{int(abr)}kbps" if abr and abr > 0 else "Audio"
+                quality_label = f"{bitrate} • {ext.upper()}"
+
+            seen_formats[dedup_key] = (quality, {
+                "format_id": _g("format_id", ""),
+                "ext": ext,
+                "filesize": filesize,
+                "vcodec": vcodec,
+                "acodec": acodec,
+                "fps": fps,
+                "vbr": _g("vbr"),
+                "abr": abr,
+                "width": width,
+                "height": height,
+                "tbr": tbr,
+                "resolution": resolution,
+                "quality_label": quality_label,
+            })
+
+        # Don't filter out formats without filesize - keep all valid formats.
+        # reverse=True keeps ties in insertion order, same as the negated ascending key.
+        ranked = sorted(seen_formats.values(), key=_QUALITY_KEY, reverse=True)
+        formats = [fmt for _, fmt in ranked]
+
         return {
             "title": info.get("title", "Unknown Title"),
             "duration": info.get("duration", 0),
             "thumbnail": info.get("thumbnail"),
             "formats": formats,
+            "categorized": self.categorize_formats(formats),  # convenience for UI
         }
 
-    def _add_quality_labels(self, formats: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        for f in formats:
-            vcodec = f.get("vcodec", "none")
-            acodec = f.get("acodec", "none")
-            resolution = f.get("resolution", "")
-            fps = f.get("fps")
-            abr = f.get("abr")
-            ext = f.get("ext", "")
-            height = f.get("height")
-            
-            if vcodec != "none" and acodec != "none":
-                # Complete file (video + audio)
-                fps_str = f" {int(fps)}fps" if fps else ""
-                quality_str = f"{height}p" if height else resolution
-                f["quality_label"] = f"{quality_str}{fps_str} • {ext.upper()}"
-            elif vcodec != "none":
-                # Video only
-                fps_str = f" {int(fps)}fps" if fps else ""
-                quality_str = f"{height}p" if height else resolution
-                f["quality_label"] = f"{quality_str}{fps_str} • {ext.upper()} (video only)"
-            else:
-                # Audio only
-                if abr and abr > 0:
-                    bitrate = f"{int(abr)}kbps"
-                else:
-                    bitrate = "Audio"
-                f["quality_label"] = f"{bitrate} • {ext.upper()}"
-        return formats
-
     def categorize_formats(self, formats: List[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
-        categorized = {"video_audio": [], "video_only": [], "audio_only": []}
+        """Split quality-sorted formats into video+audio, video-only and audio-only.
+
+        The input order (height, fps, abr, tbr descending) already orders each
+        category correctly, so a stable partition needs no per-category sort.
+        """
+        categorized: Dict[str, List[Dict[str, Any]]] = {"video_audio": [], "video_only": [], "audio_only": []}
+        # (has video, has audio) -> bucket append; formats with neither are dropped in _parse_formats
+        buckets = {
+            (True, True): categorized["video_audio"].append,
+            (True, False): categorized["video_only"].append,
+            (False, True): categorized["audio_only"].append,
+        }
         for f in formats:
-            vcodec = f.get("vcodec", "none")
-            acodec = f.get("acodec", "none")
-            if vcodec != "none" and acodec != "none":
-                categorized["video_audio"].append(f)
-            elif vcodec != "none":
-                categorized["video_only"].append(f)
-            else:
-                categorized["audio_only"].append(f)
-        
-        # Sort each category by quality (higher resolution/bitrate first)
-        def sort_key_video(f):
-            height = f.get("height") or 0
-            fps = f.get("fps") or 0
-            return (-height, -fps)
-        
-        def sort_key_audio(f):
-            abr = f.get("abr") or 0
-            return -abr
-        
-        categorized["video_audio"].sort(key=sort_key_video)
-        categorized["video_only"].sort(key=sort_key_video)
-        categorized["audio_only"].sort(key=sort_key_audio)
-        
+            buckets[f["vcodec"] != "none", f["acodec"] != "none"](f)
         return categorized
 
 
@@ -307,6 +539,43 @@ class FormatAnalyzer:
 # ----------------------------
 
 
+TERMINAL_STATUSES = frozenset({"complete", "failed", "cancelled"})
+NOT_FOUND_SSE_EVENT = b'data: {"error":"Download not found"}\n\n'
+
+# Constant part of the yt-dlp download command (everything but -f, -o and the source),
+# with aggressive 403 workarounds
+YTDLP_DOWNLOAD_ARGS: Tuple[str, ...] = (
+    "--newline",
+    "--no-playlist",
+    "--extractor-args", f"youtube:player_client={','.join(YTDLP_PLAYER_CLIENTS)}",
+    # Headers to mimic real browser
+    *(arg for name, value in YTDLP_HTTP_HEADERS.items() for arg in ("--add-header", f"{name}:{value}")),
+    "--no-check-certificate",
+    # Network options
+    "--retries", "10",
+    "--fragment-retries", "10",
+    "--retry-sleep", "1",
+    # Force IPv4 (sometimes helps)
+    "-4",
+    # Allow format fallback
+    "--format-sort", "res,ext:mp4:m4a",
+)
+
+# "[download]  42.1% of ~ 12.34MiB at  1.23MiB/s ETA 00:07 (frag 3/20)"
+# Both patterns match raw stdout bytes; only the captured groups get decoded
+PROGRESS_RE = re.compile(
+    rb"\[download\]\s+(?P<pct>\d+(?:\.\d+)?)%"
+    rb"(?:.*?\bat\s+(?P<speed>\S.*?/s))?"
+    rb"(?:.*?\bETA\s+(?P<eta>\S+))?"
+)
+# Where yt-dlp is writing the (final, once merged) file
+DESTINATION_RE = re.compile(
+    rb'^\[download\] Destination: (?P<dest>.+)$'
+    rb'|^\[Merger\] Merging formats into "(?P<merged>.+)"$'
+    rb'|^\[download\] (?P<existing>.+) has already been downloaded'
+)
+
+
 @dataclass
 class DownloadState:
     id: str
@@ -323,16 +592,58 @@ class DownloadState:
     completed_at: Optional[float] = None
     final_path: Optional[str] = None
     cancel_requested: bool = False
+    info: Optional[Dict[str, Any]] = field(default=None, repr=False)  # pre-extracted yt-dlp info
+    version: int = 0
+    last_progress_notify: float = field(default=0.0, repr=False)  # monotonic time
+    cond: threading.Condition = field(default_factory=threading.Condition, repr=False)
+    # Last published snapshot and its SSE encoding; replaced (never mutated) on
+    # each notify so readers always see a consistent status/progress/speed/eta
+    published: Dict[str, Any] = field(default_factory=dict, repr=False)
+    sse_event: bytes = field(default=b"", repr=False)
+
+    def __post_init__(self) -> None:
+        self._publish()
+
+    def notify(self) -> None:
+        """Bump the version, publish a fresh snapshot and wake waiting progress streams."""
+        with self.cond:
+            self.version += 1
+            self._publish()
+            self.cond.notify_all()
+
+    @property
+    def finished(self) -> bool:
+        return self.published["status"] in TERMINAL_STATUSES or self.published["error"] is not None
+
+    def _publish(self) -> None:
+        snapshot = {
+            "status": self.status,
+            "progress": self.progress,
+            "speed": self.speed,
+            "eta": self.eta,
+            "error": self.error,
+        }
+        self.sse_event = b"data: " + json_dumpb(snapshot) + b"\n\n"
+        self.published = snapshot
 
 
 class DownloadOrchestrator:
     def __init__(self, download_dir: str, max_workers: int = 3):
         self.download_dir = ensure_download_dir(download_dir)
-        self.active_downloads: Dict[str, DownloadState] = {}
+        self.active_downloads = ShardedDict()  # download_id -> DownloadState
         self.executor = ThreadPoolExecutor(max_workers=max_workers)
-
-    def start_download(self, url: str, format_id: str) -> str:
+        # (finished_at, download_id) for every terminal download, oldest first
+        self._expiry_heap: List[Tuple[float, str]] = []
+        self._expiry_lock = threading.Lock()
+        self._shutdown = threading.Event()
+        # URLs whose download from the analyzer's info failed; later attempts
+        # extract again from the URL so YTDLP_DOWNLOAD_ARGS' wider client list applies
+        self._extract_fresh = TTLCache(maxsize=ANALYZE_CACHE_SIZE, ttl=RAW_INFO_TTL)
+
+    def start_download(self, url: str, format_id: str, info: Optional[Dict[str, Any]] = None) -> str:
         download_id = secrets.token_urlsafe(16)
+        if info is not None and self._extract_fresh.get(normalize_youtube_url(url)):
+            info = None
         output_path = str(self.download_dir / f"{download_id}.%(ext)s")
         state = DownloadState(
             id=download_id,
@@ -340,81 +651,65 @@ class DownloadOrchestrator:
             format_id=format_id,
             status="queued",
             output_path=output_path,
+            info=info,
         )
-        self.active_downloads[download_id] = state
+        self.active_downloads.set(download_id, state)
+        if len(self.active_downloads) > MAX_TRACKED_DOWNLOADS:
+            self._evict_oldest()
         future = self.executor.submit(self._download_worker, state)
         future.add_done_callback(lambda f: self._handle_completion(download_id, f))
         return download_id
 
     def _download_worker(self, state: DownloadState) -> None:
         state.status = "downloading"
+        state.notify()
         stderr_lines = []
+        info_path = None
         
         try:
-            # Base command with aggressive 403 workarounds
+            # Reuse the analyze step's extraction instead of re-fetching the page
+            info_path = self._write_info_json(state)
+            source = ["--load-info-json", info_path] if info_path else [state.url]
             cmd = [
                 get_ytdlp_binary(),
                 "-f",
                 state.format_id,
-                "--newline",
-                "--no-playlist",
-                # Use multiple player clients for better compatibility
-                "--extractor-args", "youtube:player_client=ios,android,web",
-                # Headers to mimic real browser
-                "--user-agent", "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-                "--referer", "https://www.youtube.com/",
-                "--add-header", "Accept-Language:en-US,en;q=0.9",
-                "--add-header", "Accept:text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-                "--add-header", "Sec-Fetch-Mode:navigate",
-                "--no-check-certificate",
-                # Network options
-                "--retries", "10",
-                "--fragment-retries", "10",
-                "--retry-sleep", "1",
-                # Force IPv4 (sometimes helps)
-                "-4",
-                # Allow format fallback
-                "--format-sort", "res,ext:mp4:m4a",
-                # Output
+                *YTDLP_DOWNLOAD_ARGS,
                 "-o",
                 state.output_path,
-                state.url,
+                *source,
             ]
             process = subprocess.Popen(
                 cmd,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
-                text=True,
-                bufsize=1,
                 shell=False,
-                env={**os.environ, "HOME": "/tmp"},
+                env=YTDLP_ENV,
             )
             state.process = process
 
-            if not process.stdout:
+            if not process.stdout or not process.stderr:
                 raise RuntimeError("Failed to read yt-dlp output")
 
-            # Read stdout for progress
-            for line in process.stdout:
-                if state.cancel_requested:
-                    try:
-                        process.kill()
-                    finally:
-                        state.status = "cancelled"
-                        return
-                self._parse_progress_line(line, state)
+            # Read stdout for progress, collecting stderr alongside
+            stderr_buf = bytearray()
+            if not self._pump_output(process, state, stderr_buf):
+                try:
+                    process.kill()
+                finally:
+                    state.status = "cancelled"
+                    return
 
             process.wait(timeout=YTDLP_TIMEOUT)
-            
-            # Capture stderr for errors
-            if process.stderr:
-                stderr_lines = process.stderr.readlines()
+            stderr_lines = stderr_buf.decode("utf-8", "replace").splitlines(keepends=True)
 
             if process.returncode == 0:
                 state.status = "complete"
                 state.progress = 100.0
                 state.completed_at = time.time()
-                state.final_path = self._find_downloaded_file(state)
+                final_path = self._find_downloaded_file(state)
+                # Resolved once here so serving it needs no realpath walk per request
+                state.final_path = os.path.realpath(final_path) if final_path else None
                 if state.final_path and os.path.exists(state.final_path):
                     size_mb = os.path.getsize(state.final_path) / (1024**2)
                     log.info(f"Download complete: {state.id} - {size_mb:.1f}MB")
@@ -471,33 +766,88 @@ class DownloadOrchestrator:
             state.error = str(e)
             log.error(f"Download {state.id} failed: {e}")
             self._cleanup_partial_files(state)
-
-    def _parse_progress_line(self, line: str, state: DownloadState) -> None:
-        if "[download]" not in line:
+        finally:
+            if info_path:
+                if state.status == "failed":
+                    # Re-analyzing yields the same single-client info, so a retry must not reuse it
+                    self._extract_fresh.set(normalize_youtube_url(state.url), True)
+                try:
+                    os.remove(info_path)
+                except OSError:
+                    pass
+            self._mark_finished(state)
+            state.notify()
+
+    def _write_info_json(self, state: DownloadState) -> Optional[str]:
+        if not state.info:
+            return None
+        # Outside download_dir: it holds signed stream URLs and must never be servable
+        fd, path = tempfile.mkstemp(prefix="fetch-", suffix=".info.json")
+        with os.fdopen(fd, "wb") as f:
+            f.write(json_dumpb(state.info))
+        state.info = None
+        return path
+
+    def _pump_output(self, process: subprocess.Popen, state: DownloadState, stderr_buf: bytearray) -> bool:
+        """Drain stdout (progress) and stderr (tail kept) until EOF; False if cancelled."""
+        out_fd = process.stdout.fileno()
+        err_fd = process.stderr.fileno()
+        # Raw bytes from the pipe; complete lines are parsed without decoding
+        buf = bytearray()
+        with selectors.DefaultSelector() as sel:
+            for fd in (out_fd, err_fd):
+                os.set_blocking(fd, False)
+                sel.register(fd, selectors.EVENT_READ)
+            while sel.get_map():
+                if state.cancel_requested:
+                    return False
+                for key, _ in sel.select(timeout=CANCEL_POLL_INTERVAL):
+                    try:
+                        chunk = os.read(key.fd, 65536)
+                    except BlockingIOError:
+                        continue
+                    if not chunk:
+                        sel.unregister(key.fd)
+                    elif key.fd == err_fd:
+                        stderr_buf += chunk
+                        del stderr_buf[:-STDERR_TAIL_BYTES]
+                    else:
+                        buf += chunk
+                        # yt-dlp may redraw progress with \r instead of \n
+                        end = max(buf.rfind(b"\n"), buf.rfind(b"\r"))
+                        if end < 0:
+                            continue
+                        for line in bytes(buf[:end]).splitlines():
+                            self._parse_progress_line(line, state)
+                        del buf[:end + 1]
+        if buf:
+            self._parse_progress_line(bytes(buf), state)
+        return True
+
+    def _parse_progress_line(self, line: bytes, state: DownloadState) -> None:
+        m = PROGRESS_RE.search(line)
+        if not m:
+            dest = DESTINATION_RE.search(line.rstrip())
+            if dest:
+                state.final_path = dest[dest.lastgroup].decode("utf-8", "replace")
             return
-        if "%" in line:
-            try:
-                percent_str = line.split("%", 1)[0].split()[-1]
-                state.progress = float(percent_str)
-            except Exception:
-                pass
-        if " at " in line and "/s" in line:
-            try:
-                after_at = line.split(" at ", 1)[1]
-                speed = after_at.split(" ETA", 1)[0].strip()
-                state.speed = speed
-            except Exception:
-                pass
-        if "ETA" in line:
-            try:
-                eta = line.split("ETA", 1)[1].strip()
-                state.eta = eta
-            except Exception:
-                pass
+        state.progress = float(m["pct"])
+        if m["speed"]:
+            state.speed = m["speed"].decode("ascii", "replace")
+        if m["eta"]:
+            state.eta = m["eta"].decode("ascii", "replace")
+        # Fast downloads print many lines per second; publish at most every
+        # PROGRESS_UPDATE_INTERVAL (terminal states always publish)
+        now = time.monotonic()
+        if now - state.last_progress_notify >= PROGRESS_UPDATE_INTERVAL:
+            state.last_progress_notify = now
+            state.notify()
 
     def _find_downloaded_file(self, state: DownloadState) -> Optional[str]:
-        pattern = state.output_path.replace(".%(ext)s", ".*")
-        matches = glob.glob(pattern)
+        # yt-dlp reports the destination on stdout; only scan if that was missed
+        if state.final_path and os.path.exists(state.final_path):
+            return state.final_path
+        matches = scan_download_files(self.download_dir, state.id, include_partial=False)
         return matches[0] if matches else None
 
     def _handle_completion(self, download_id: str, future: Future) -> None:
@@ -509,46 +859,82 @@ class DownloadOrchestrator:
                 state.status = "failed"
                 state.error = str(e)
                 self._cleanup_partial_files(state)
+                self._mark_finished(state)
+                state.notify()
             log.error(f"Download {download_id} failed: {e}")
 
     def _cleanup_partial_files(self, state: DownloadState) -> None:
-        pattern = state.output_path.replace(".%(ext)s", ".*")
-        for filepath in glob.glob(pattern):
+        for filepath in scan_download_files(self.download_dir, state.id):
             try:
                 os.remove(filepath)
             except OSError:
                 pass
 
-    def get_progress(self, download_id: str) -> Dict[str, Any]:
+    def get_final_path(self, download_id: str) -> Optional[str]:
+        state = self.active_downloads.get(download_id)
+        if state and state.status == "complete":
+            return state.final_path
+        return None
+
+    def wait_for_progress(self, download_id: str, last_version: int, timeout: float) -> Tuple[int, Optional[bytes], bool]:
+        """Block until the download's version moves past `last_version`.
+
+        Returns `(version, sse_event, finished)`, with `sse_event` None if
+        nothing changed within `timeout` seconds.
+        """
         state = self.active_downloads.get(download_id)
         if not state:
-            return {"error": "Download not found"}
-        return {
-            "status": state.status,
-            "progress": state.progress,
-            "speed": state.speed,
-            "eta": state.eta,
-            "error": state.error,
-        }
+            return last_version, NOT_FOUND_SSE_EVENT, True
+        with state.cond:
+            if not state.cond.wait_for(lambda: state.version != last_version, timeout=timeout):
+                return last_version, None, False
+            return state.version, state.sse_event, state.finished
+
+    def wait_for_shutdown(self, timeout: float) -> bool:
+        """Sleep up to `timeout` seconds; returns True once shutdown() was called."""
+        return self._shutdown.wait(timeout)
+
+    def shutdown(self) -> None:
+        self._shutdown.set()
+        for _, state in self.active_downloads.snapshot():
+            if state.status == "downloading":
+                state.cancel_requested = True
+        self.executor.shutdown(wait=False, cancel_futures=True)
 
     def cancel_download(self, download_id: str) -> None:
         state = self.active_downloads.get(download_id)
         if state and state.status == "downloading":
             state.cancel_requested = True
 
+    def _mark_finished(self, state: DownloadState) -> None:
+        with self._expiry_lock:
+            heapq.heappush(self._expiry_heap, (state.completed_at or time.time(), state.id))
+
+    def _forget(self, download_id: str) -> None:
+        state = self.active_downloads.pop(download_id)
+        if state and state.final_path and os.path.exists(state.final_path):
+            try:
+                os.remove(state.final_path)
+            except OSError:
+                pass
+
+    def _evict_oldest(self) -> None:
+        with self._expiry_lock:
+            if not self._expiry_heap:
+                return
+            _, download_id = heapq.heappop(self._expiry_heap)
+        self._forget(download_id)
+        log.info(f"Evicted download over tracking cap: {download_id}")
+
     def cleanup_expired_downloads(self) -> None:
+        # Heap is ordered by finish time, so work is proportional to expirations
         cutoff = time.time() - (FILE_RETENTION_HOURS * 3600)
-        to_delete = []
-        for download_id, state in list(self.active_downloads.items()):
-            if state.completed_at and state.completed_at < cutoff:
-                if state.final_path and os.path.exists(state.final_path):
-                    try:
-                        os.remove(state.final_path)
-                    except OSError:
-                        pass
-                to_delete.append(download_id)
-        for download_id in to_delete:
-            self.active_downloads.pop(download_id, None)
+        expired = []
+        with self._expiry_lock:
+            while self._expiry_heap and self._expiry_heap[0][0] < cutoff:
+                expired.append(heapq.heappop(self._expiry_heap)[1])
+        for download_id in expired:
+            self._forget(download_id)
             log.info(f"Cleaned up expired download: {download_id}")
 
 
@@ -558,24 +944,38 @@ class DownloadOrchestrator:
 
 
 class StorageAgent:
-    def __init__(self, download_dir: str = "./downloads"):
+    def __init__(
+        self,
+        download_dir: str = "./downloads",
+        xaccel_prefix: str = "",
+        known_path: Optional[Callable[[str], Optional[str]]] = None,
+    ):
         self.download_dir = Path(download_dir)
         self.download_dir.mkdir(exist_ok=True, parents=True)
+        self._resolved_root = self.download_dir.resolve()  # resolved once, not per request
+        self._root_prefix = str(self._resolved_root) + os.sep
+        self.xaccel_prefix = xaccel_prefix
+        # download_id -> path already known to the orchestrator, to skip the directory scan
+        self.known_path = known_path
 
     def get_file_path(self, download_id: str) -> Path:
-        if not re.match(r"^[a-zA-Z0-9_\-]{16,32}$", download_id or ""):
+        if not _DOWNLOAD_ID_RE.match(download_id or ""):
             raise ValueError("Invalid download ID")
-        pattern = f"{download_id}.*"
-        matches = list(self.download_dir.glob(pattern))
-        if not matches:
-            raise FileNotFoundError(f"Download {download_id} not found")
+        # Known paths are already resolved by the orchestrator; only scanned ones need resolve()
+        known = self.known_path(download_id) if self.known_path else None
+        if known and os.path.exists(known):
+            resolved = known
+        else:
+            matches = scan_download_files(self.download_dir, download_id, include_partial=False)
+            if not matches:
+                raise FileNotFoundError(f"Download {download_id} not found")
+            resolved = os.path.realpath(matches[0])
         
         # Verify path is within download directory (defense in depth)
-        filepath = matches[0].resolve()
-        if not str(filepath).startswith(str(self.download_dir.resolve())):
+        if not resolved.startswith(self._root_prefix):
             raise ValueError("Path traversal attempt detected")
         
-        return filepath
+        return Path(resolved)
 
     def get_file_info(self, filepath: Path) -> Dict[str, Any]:
         stat = filepath.stat()
@@ -601,11 +1001,22 @@ class StorageAgent:
     def serve_file(self, download_id: str) -> Response:
         filepath = self.get_file_path(download_id)
         info = self.get_file_info(filepath)
-        return send_file(
-            filepath,
+        if self.xaccel_prefix:
+            # The proxy streams the file with sendfile(2); this worker returns immediately
+            response = Response(status=200, mimetype=info["mimetype"])
+            response.headers["X-Accel-Redirect"] = f"{self.xaccel_prefix}{urllib.parse.quote(filepath.name)}"
+            response.headers.set("Content-Disposition", "attachment", filename=info["filename"])
+            return response
+        # Dev server only (gunicorn brings its own sendfile wrapper): 1MB reads instead of 8KB
+        request.environ.setdefault("wsgi.file_wrapper", lambda f, _bs=None: FileWrapper(f, FILE_CHUNK_SIZE))
+        # Honors Range/If-None-Match, and emits X-Sendfile when USE_X_SENDFILE is on
+        return send_from_directory(
+            self._resolved_root,
+            filepath.name,
             mimetype=info["mimetype"],
             as_attachment=True,
             download_name=info["filename"],
+            conditional=True,
         )
 
 
@@ -615,26 +1026,51 @@ class StorageAgent:
 
 
 downloads_path = ensure_download_dir(DOWNLOAD_DIR)
+# Shared by /analyze and /health; bounds concurrent yt-dlp info processes
+analyze_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT, thread_name_prefix="analyze")
 orchestrator = DownloadOrchestrator(download_dir=str(downloads_path), max_workers=MAX_CONCURRENT)
-storage = StorageAgent(download_dir=str(downloads_path))
-analyzer = FormatAnalyzer(timeout=30)
-cobalt = CobaltDownloader()
+storage = StorageAgent(
+    download_dir=str(downloads_path),
+    xaccel_prefix=XACCEL_REDIRECT_PREFIX,
+    known_path=orchestrator.get_final_path,
+)
+analyzer = FormatAnalyzer(executor=analyze_executor, timeout=30)
+cobalt = CobaltDownloader(cache=TTLCache(maxsize=COBALT_CACHE_SIZE, ttl=COBALT_CACHE_TTL))
 
 # Simple in-memory rate limiting for /analyze
 MAX_ANALYSIS_PER_MINUTE = 10
-analysis_attempts: Dict[str, List[float]] = {}
+analysis_attempts = ShardedDict()  # ip -> Deque[float] of recent attempt times
 
 
 @app.before_request
 def rate_limit() -> None:
     if request.endpoint == "analyze_url":
         ip = request.remote_addr or "unknown"
-        now = time.time()
-        timestamps = [t for t in analysis_attempts.get(ip, []) if now - t < 60]
-        if len(timestamps) >= MAX_ANALYSIS_PER_MINUTE:
-            abort(429, description="Too many requests - wait a minute")
-        timestamps.append(now)
-        analysis_attempts[ip] = timestamps
+        now = time.monotonic()  # immune to wall-clock jumps
+        with analysis_attempts.locked_shard(ip) as attempts:
+            timestamps: Optional[Deque[float]] = attempts.get(ip)
+            if timestamps is None:
+                timestamps = attempts[ip] = deque(maxlen=MAX_ANALYSIS_PER_MINUTE)
+            while timestamps and now - timestamps[0] >= 60:
+                timestamps.popleft()
+            if len(timestamps) >= MAX_ANALYSIS_PER_MINUTE:
+                abort(429, description="Too many requests - wait a minute")
+            timestamps.append(now)
+
+
+# Encoded /analyze bodies, reused while the analyzer returns the same result object
+analysis_bodies = TTLCache(maxsize=ANALYZE_CACHE_SIZE, ttl=ANALYZE_CACHE_TTL)
+
+
+def encode_analysis(url: str, data: Dict[str, Any]) -> Tuple[str, bytes]:
+    key = normalize_youtube_url(url)
+    entry = analysis_bodies.get(key)
+    if entry is not None and entry[0] is data:
+        return entry[1], entry[2]
+    payload = json_dumpb(data)
+    etag = hashlib.blake2b(payload, digest_size=16).hexdigest()
+    analysis_bodies.set(key, (data, etag, payload))
+    return etag, payload
 
 
 # ----------------------------
@@ -653,18 +1089,33 @@ def analyze_url() -> Response:
     url = body.get("url", "").strip()
     if not is_valid_youtube_url(url):
         return jsonify({"error": "Invalid YouTube URL"}), 400
+    if body.get("refresh"):
+        analyzer.invalidate(url)
     try:
         log.info(f"Analyzing URL: {url}")
-        data = analyzer.get_formats(url)
+        future = analyzer.get_formats_async(url)
+        data = future.result(timeout=analyzer.timeout + 5)
         log.info(f"Found {len(data.get('formats', []))} formats for: {data.get('title', 'Unknown')}")
-        return jsonify(data)
-    except TimeoutError:
+        etag, payload = encode_analysis(url, data)
+        if request.if_none_match.contains(etag):
+            resp = app.response_class(status=304)
+        else:
+            resp = app.response_class(payload, mimetype="application/json")
+        resp.set_etag(etag)
+        resp.headers["Cache-Control"] = "private, max-age=60"
+        return resp
+    # Before 3.11 future.result()'s timeout is not the builtin TimeoutError,
+    # which _get_formats_blocking raises for a slow yt-dlp
+    except (TimeoutError, FutureTimeoutError):
         log.warning(f"Analysis timeout for: {url}")
+        analyzer.invalidate(url)
         return jsonify({"error": "Request timed out"}), 504
     except YtDlpError as e:
+        analyzer.invalidate(url)
         return jsonify({"error": f"Could not fetch video info: {e}"}), 502
     except Exception as e:
         log.exception("Unexpected error during analysis")
+        analyzer.invalidate(url)
         return jsonify({"error": f"Unexpected error: {e}"}), 500
 
 
@@ -681,7 +1132,7 @@ def start_download() -> Response:
         return jsonify({"error": str(e)}), 400
 
     try:
-        download_id = orchestrator.start_download(url, format_id)
+        download_id = orchestrator.start_download(url, format_id, info=analyzer.get_raw_info(url))
         log.info(f"Download started: {download_id}")
         return jsonify({"download_id": download_id, "status": "queued"})
     except Exception as e:
@@ -692,23 +1143,18 @@ def start_download() -> Response:
 @app.route("/progress/<download_id>")
 def stream_progress(download_id: str) -> Response:
     def event_stream() -> Any:
-        last_emit = 0.0
+        last_version = -1
         while True:
-            state = orchestrator.get_progress(download_id)
-            payload = json.dumps(state)
-            yield f"data: {payload}\n\n"
+            # Blocks until the worker publishes a change; times out for keep-alives
+            last_version, event, finished = orchestrator.wait_for_progress(download_id, last_version, timeout=15)
+            if event is None:
+                yield b": keep-alive\n\n"
+                continue
 
-            status = state.get("status")
-            if status in {"complete", "failed", "cancelled"} or state.get("error"):
+            yield event
+            if finished:
                 break
 
-            now = time.time()
-            if now - last_emit > 15:
-                yield ": keep-alive\n\n"
-                last_emit = now
-
-            time.sleep(PROGRESS_UPDATE_INTERVAL)
-
     headers = {
         "Content-Type": "text/event-stream",
         "Cache-Control": "no-cache",
@@ -757,24 +1203,22 @@ def download_with_cobalt() -> Response:
         else:
             result = cobalt.get_download_url(url, quality)
         
-        if not result or not result.get("url"):
+        if not result or not result.url:
             return jsonify({"error": "Cobalt API failed to get download URL"}), 502
         
-        download_url = result["url"]
-        filename = result.get("filename", "video.mp4")
+        download_url = result.url
+        filename = result.filename or "video.mp4"
         
         # Download the file from Cobalt's URL
         download_id = secrets.token_urlsafe(16)
         output_path = downloads_path / f"{download_id}_{filename}"
         
-        # Stream download from Cobalt
-        response = requests.get(download_url, stream=True, timeout=300)
-        response.raise_for_status()
-        
-        with open(output_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
+        # Stream download from Cobalt in 1MB copies (no per-8KB Python loop)
+        with requests.get(download_url, stream=True, timeout=300) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            with open(output_path, 'wb') as f:
+                shutil.copyfileobj(response.raw, f, length=FILE_CHUNK_SIZE)
         
         log.info(f"Cobalt download complete: {download_id}")
         
@@ -792,10 +1236,21 @@ def download_with_cobalt() -> Response:
         return jsonify({"error": f"Unexpected error: {str(e)}"}), 500
 
 
+health_cache = TTLCache(maxsize=1, ttl=HEALTH_CACHE_TTL)
+
+
 @app.route("/health")
 def health_check() -> Response:
-    def check_ytdlp_available() -> bool:
-        return get_ytdlp_version() is not None
+    def check_ytdlp_available() -> Optional[bool]:
+        # Warm cache: no need to queue behind running analyses
+        if _ytdlp_version_cache.get("version") is not None:
+            return True
+        try:
+            return analyze_executor.submit(get_ytdlp_version).result(timeout=10) is not None
+        except FutureTimeoutError:
+            return None  # pool busy with analyses: unknown, not unavailable
+        except Exception:
+            return False
 
     def check_disk_space() -> bool:
         try:
@@ -805,13 +1260,24 @@ def health_check() -> Response:
         except Exception:
             return False
 
+    # Probes arrive every few seconds; don't fork yt-dlp or statvfs for each one
+    cached = health_cache.get("checks")
+    if cached is None:
+        cached = {
+            "ytdlp": check_ytdlp_available(),
+            "disk_space": check_disk_space(),
+        }
+        # A busy (unknown) result is transient; re-probe next time
+        if cached["ytdlp"] is not None:
+            health_cache.set("checks", cached)
+
     checks = {
-        "ytdlp": check_ytdlp_available(),
-        "disk_space": check_disk_space(),
+        **cached,
         "downloads_dir": downloads_path.exists(),
         "active_downloads": len(orchestrator.active_downloads),
     }
-    if checks["ytdlp"] and checks["disk_space"] and checks["downloads_dir"]:
+    # ytdlp None means the probe couldn't run, not that yt-dlp is missing
+    if checks["ytdlp"] is not False and checks["disk_space"] and checks["downloads_dir"]:
         return jsonify({**checks, "status": "healthy"}), 200
     return jsonify({**checks, "status": "degraded"}), 503
 
@@ -821,11 +1287,20 @@ def health_check() -> Response:
 # ----------------------------
 
 
+def prune_analysis_attempts() -> None:
+    now = time.monotonic()
+    removed = analysis_attempts.discard_if(lambda ip, timestamps: not timestamps or now - timestamps[-1] >= 60)
+    if removed:
+        log.info(f"Pruned rate-limit state for {removed} idle clients")
+
+
 def periodic_cleanup() -> None:
-    while True:
-        time.sleep(3600)
+    # Both passes only touch expired entries, so running every minute is cheap
+    # and keeps idle rate-limit state bounded to roughly two windows of clients
+    while not orchestrator.wait_for_shutdown(CLEANUP_INTERVAL):
         try:
             orchestrator.cleanup_expired_downloads()
+            prune_analysis_attempts()
         except Exception as e:
             log.warning(f"Cleanup error: {e}")
 
@@ -844,9 +1319,17 @@ def startup_checks() -> None:
         # Do not sys.exit in hosted environments; allow /health to reflect degraded state
 
 
-def start_background_tasks() -> None:
-    import threading
+def shutdown() -> None:
+    # Must run before interpreter exit: executor threads are joined ahead of
+    # atexit callbacks, so from there in-flight downloads could not be cancelled.
+    # Called from gunicorn's worker_exit hook (gunicorn.conf.py) and by __main__.
+    orchestrator.shutdown()
+    analyze_executor.shutdown(wait=False, cancel_futures=True)
+    _native_executor.shutdown(wait=False, cancel_futures=True)
+    cobalt.close()
+
 
+def start_background_tasks() -> None:
     cleanup_thread = threading.Thread(target=periodic_cleanup, daemon=True)
     cleanup_thread.start()
 
@@ -862,6 +1345,9 @@ start_background_tasks()
 if __name__ == "__main__":
     log.info("Fetch started")
     log.info(f"Downloads directory: {DOWNLOAD_DIR}")
-    app.run(host="0.0.0.0", port=PORT, threaded=True)
+    try:
+        app.run(host="0.0.0.0", port=PORT, threaded=True)
+    finally:
+        shutdown()
 
 
@@ -3,108 +3,326 @@ Cobalt API fallback for when yt-dlp fails with 403 errors.
 Cobalt (cobalt.tools) is a modern download service that handles YouTube restrictions well.
 """
 
+import logging
+import random
+import threading
+import time
 import requests
-from typing import Dict, Any, Optional
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from requests.adapters import HTTPAdapter
+from typing import Dict, Any, List, Optional
+
+log = logging.getLogger("fetch.cobalt")
+
+# orjson when available (it is for the app); the stdlib keeps this module standalone.
+# Both decoders raise ValueError subclasses on bad input.
+try:
+    import orjson
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+except ImportError:
+    import json
+
+    def _json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj, separators=(",", ":")).encode()
+
+    _json_loads = json.loads
+
+# Connections kept per host; also caps concurrent lookups in batch calls
+POOL_MAXSIZE = 20
+
+# Transient statuses worth retrying; other 4xx are our request's fault
+RETRY_STATUSES = frozenset({408, 429, 500, 502, 503, 504})
+
+
+def _retry_after_seconds(response: requests.Response) -> float:
+    # Retry-After may also be an HTTP date; only the seconds form is honored
+    try:
+        return max(0.0, float(response.headers.get("Retry-After", 0)))
+    except ValueError:
+        return 0.0
+
+
+@dataclass(frozen=True)
+class CobaltResult:
+    """A resolved direct download link"""
+    
+    # Explicit __slots__ rather than dataclass(slots=True), which needs Python 3.10
+    __slots__ = ("url", "filename")
+    
+    url: str
+    filename: str
+    
+    def as_dict(self) -> Dict[str, str]:
+        return asdict(self)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the API while the circuit breaker is open"""
+
+
+class CobaltCircuitBreaker:
+    """
+    Fail fast while the Cobalt API is down
+    
+    Trips OPEN after `threshold` consecutive failures, or when more than
+    `error_pct` of the last `window` calls failed. While OPEN every call is
+    refused for `sleep_window` seconds; then a single probe is let through
+    (HALF_OPEN) and its outcome closes or re-opens the circuit.
+    """
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    def __init__(self, threshold: int = 5, sleep_window: float = 10.0, error_pct: float = 0.5, window: int = 20):
+        self.threshold = threshold
+        self.sleep_window = sleep_window
+        self.error_pct = error_pct
+        self.state = self.CLOSED
+        self.failure_count = 0  # consecutive
+        self.opened_at = 0.0
+        self._outcomes: deque = deque(maxlen=window)  # True = success
+        self._lock = threading.Lock()
+        
+    def before_call(self) -> None:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.sleep_window:
+                self.state = self.HALF_OPEN  # this caller is the probe
+                return
+            raise CircuitOpenError("Cobalt API circuit is open")
+            
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state != self.CLOSED:
+                self._outcomes.clear()
+            self.state = self.CLOSED
+            self.failure_count = 0
+            self._outcomes.append(True)
+            
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failure_count += 1
+            self._outcomes.append(False)
+            failed = self._outcomes.count(False)
+            if (
+                self.state == self.HALF_OPEN
+                or self.failure_count >= self.threshold
+                or (len(self._outcomes) == self._outcomes.maxlen and failed / len(self._outcomes) > self.error_pct)
+            ):
+                if self.state != self.OPEN:
+                    log.warning(f"Cobalt API circuit opened for {self.sleep_window}s after {self.failure_count} consecutive failures")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
 
 
 class CobaltDownloader:
     """Fallback downloader using Cobalt API"""
     
-    def __init__(self, api_url: str = "https://api.cobalt.tools"):
+    # Shared by all instances: they talk to the same service
+    _breaker = CobaltCircuitBreaker()
+    
+    def __init__(
+        self,
+        api_url: str = "https://api.cobalt.tools",
+        cache: Optional[Any] = None,
+        connect_timeout: float = 3.05,
+        read_timeout: float = 15.0,
+    ):
+        """
+        Args:
+            api_url: Cobalt API base URL
+            cache: Optional results cache with get(key) / set(key, value), e.g. a
+                TTL cache; Cobalt's signed URLs stay valid for a few minutes
+            connect_timeout: Seconds to establish TCP+TLS; keep just above the
+                observed p95 handshake time so a dead host fails (and counts
+                against the circuit breaker) fast
+            read_timeout: Seconds to wait for the response; raise it for callers
+                expecting slow "picker" responses
+        """
         self.api_url = api_url
+        self._endpoint = api_url.rstrip("/") + "/"
+        self.cache = cache
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        # One pooled session so repeat calls reuse the TCP+TLS connection
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=POOL_MAXSIZE, pool_block=False)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Accept": "application/json",
+            "Content-Type": "application/json",
+        })
+        
+    def close(self) -> None:
+        """Close pooled connections"""
+        self.session.close()
+        
+    def __enter__(self) -> "CobaltDownloader":
+        return self
         
-    def get_download_url(self, video_url: str, quality: str = "max") -> Optional[Dict[str, Any]]:
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+        
+    def _post_with_retry(
+        self, payload: Dict[str, Any], attempts: int = 3, base: float = 0.5, cap: float = 8.0
+    ) -> requests.Response:
         """
-        Get direct download URL from Cobalt API
+        POST to the API, retrying timeouts, connection errors and RETRY_STATUSES
+        
+        Sleeps min(cap, base * 2**attempt) plus jitter between tries, or the
+        server's Retry-After if longer (also bounded by cap). The final attempt's
+        response, which may still be an error status, or network error is passed
+        through to the caller.
+        """
+        # Serialized once and reused across attempts; Content-Type is a session header
+        body = _json_dumps(payload)
+        timeout = (self.connect_timeout, self.read_timeout)
+        for attempt in range(attempts - 1):
+            try:
+                response = self.session.post(self._endpoint, data=body, timeout=timeout)
+            except (requests.Timeout, requests.ConnectionError):
+                retry_after = 0.0
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    return response
+                retry_after = min(cap, _retry_after_seconds(response))
+                response.close()
+            delay = min(cap, base * (2 ** attempt)) + random.uniform(0, 0.25)
+            time.sleep(max(delay, retry_after))
+        return self.session.post(self._endpoint, data=body, timeout=timeout)
+        
+    def _guarded_post(self, payload: Dict[str, Any]) -> requests.Response:
+        """
+        _post_with_retry behind the circuit breaker
+        
+        Raises CircuitOpenError without calling the API while the circuit is open.
+        Network errors and RETRY_STATUSES responses (after retries) count as failures.
+        """
+        self._breaker.before_call()
+        ok = False
+        try:
+            response = self._post_with_retry(payload)
+            ok = response.status_code not in RETRY_STATUSES
+            return response
+        finally:
+            if ok:
+                self._breaker.record_success()
+            else:
+                self._breaker.record_failure()
+        
+    def _request(self, payload: Dict[str, Any], default_filename: str) -> Optional[CobaltResult]:
+        """
+        Shared lookup: cache, circuit breaker, retries and response parsing
         
         Args:
-            video_url: YouTube video URL
-            quality: Video quality (max, 2160, 1440, 1080, 720, 480, 360)
+            payload: Cobalt API request body
+            default_filename: Filename used when Cobalt doesn't send one
             
         Returns:
-            Dict with download info or None if failed
+            CobaltResult with the download link, or None if failed
         """
+        key = (payload["url"], payload.get("vQuality", ""), payload["isAudioOnly"])
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
         try:
-            response = requests.post(
-                f"{self.api_url}/",
-                json={
-                    "url": video_url,
-                    "vQuality": quality,
-                    "filenamePattern": "basic",
-                    "isAudioOnly": False,
-                    "disableMetadata": False,
-                },
-                headers={
-                    "Accept": "application/json",
-                    "Content-Type": "application/json",
-                },
-                timeout=30
-            )
+            response = self._guarded_post(payload)
             
             if response.status_code != 200:
                 return None
                 
-            data = response.json()
+            data = _json_loads(response.content)
+            if not isinstance(data, dict):
+                log.warning(f"Cobalt returned a non-object response: {type(data).__name__}")
+                return None
+            status = data.get("status")
+            filename = data.get("filename")
+            if not isinstance(filename, str) or not filename:
+                filename = default_filename
             
             # Cobalt returns different response types
-            if data.get("status") == "error":
-                return None
-                
-            if data.get("status") == "redirect":
+            if status == "redirect":
                 # Direct download URL
-                return {
-                    "url": data.get("url"),
-                    "filename": data.get("filename", "video.mp4"),
-                }
+                url = data.get("url")
+            elif status == "picker" and data.get("picker"):
+                # Multiple formats available; first is usually best quality
+                picker = data["picker"]
+                first = picker[0] if isinstance(picker, list) else None
+                if not isinstance(first, dict):
+                    log.warning("Cobalt returned a malformed picker response")
+                    return None
+                url = first.get("url")
+            else:
+                # "error", or nothing usable
+                return None
+            
+            # Reject here rather than after the caller has opened a connection
+            if not isinstance(url, str) or not url.startswith(("http://", "https://")):
+                log.warning(f"Cobalt returned an unusable download URL: {url!r}")
+                return None
                 
-            if data.get("status") == "picker":
-                # Multiple formats available
-                picker = data.get("picker", [])
-                if picker:
-                    # Return first (usually best quality)
-                    return {
-                        "url": picker[0].get("url"),
-                        "filename": data.get("filename", "video.mp4"),
-                    }
-                    
+        except CircuitOpenError:
             return None
-            
-        except Exception as e:
-            print(f"Cobalt API error: {e}")
+        except (requests.RequestException, ValueError):
+            # ValueError: response body was not JSON
+            log.warning("Cobalt API call failed", exc_info=True)
             return None
-    
-    def get_audio_url(self, video_url: str) -> Optional[Dict[str, Any]]:
-        """Get audio-only download URL"""
-        try:
-            response = requests.post(
-                f"{self.api_url}/",
-                json={
-                    "url": video_url,
-                    "isAudioOnly": True,
-                    "filenamePattern": "basic",
-                    "disableMetadata": False,
-                },
-                headers={
-                    "Accept": "application/json",
-                    "Content-Type": "application/json",
-                },
-                timeout=30
-            )
             
-            if response.status_code != 200:
-                return None
-                
-            data = response.json()
+        result = CobaltResult(url=url, filename=filename)
+        # Only successes are cached, so a transient outage is never pinned
+        if self.cache is not None:
+            self.cache.set(key, result)
+        return result
+        
+    def get_download_url(self, video_url: str, quality: str = "max") -> Optional[CobaltResult]:
+        """
+        Get direct download URL from Cobalt API
+        
+        Args:
+            video_url: YouTube video URL
+            quality: Video quality (max, 2160, 1440, 1080, 720, 480, 360)
             
-            if data.get("status") == "redirect":
-                return {
-                    "url": data.get("url"),
-                    "filename": data.get("filename", "audio.mp3"),
-                }
-                
-            return None
+        Returns:
+            CobaltResult with the download link, or None if failed
+        """
+        return self._request({
+            "url": video_url,
+            "vQuality": quality,
+            "filenamePattern": "basic",
+            "isAudioOnly": False,
+            "disableMetadata": False,
+        }, "video.mp4")
+    
+    def get_download_urls(self, video_urls: List[str], quality: str = "max") -> List[Optional[CobaltResult]]:
+        """
+        Resolve several videos concurrently over the pooled session
+        
+        Args:
+            video_urls: YouTube video URLs
+            quality: Video quality, as for get_download_url
             
-        except Exception as e:
-            print(f"Cobalt API error: {e}")
-            return None
+        Returns:
+            One result per URL, in input order (None where it failed)
+        """
+        if not video_urls:
+            return []
+        workers = min(len(video_urls), POOL_MAXSIZE)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(lambda url: self.get_download_url(url, quality), video_urls))
+    
+    def get_audio_url(self, video_url: str) -> Optional[CobaltResult]:
+        """Get audio-only download URL"""
+        return self._request({
+            "url": video_url,
+            "isAudioOnly": True,
+            "filenamePattern": "basic",
+            "disableMetadata": False,
+        }, "audio.mp3")
 
@@ -0,0 +1,9 @@
+# Loaded automatically by gunicorn from the working directory.
+
+
+def worker_exit(server, worker):
+    # Runs in the worker before interpreter shutdown joins executor threads,
+    # so in-flight downloads are cancelled instead of running to completion
+    from app import shutdown
+
+    shutdown()